@@ -1,7 +1,11 @@
+import heapq
 import sys
-from copy import deepcopy
+from itertools import compress, count
 from crossword import *
 
+# Maps the digits of `bin()` output to byte values usable as selectors
+BINARY_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
 
 class CrosswordCreator():
 
@@ -10,36 +14,97 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+        # Words grouped by the lengths the crossword needs; a word's id is
+        # its index within its group
+        self._lexicon = {var.length: [] for var in self.crossword.variables}
+        for word in sorted(self.crossword.words):
+            if len(word) in self._lexicon:
+                self._lexicon[len(word)].append(word)
+        self._word_id = {
+            word: i
+            for words in self._lexicon.values()
+            for i, word in enumerate(words)
+        }
+        # Bitmask of the ids of each length's words by letter and position:
+        # self._support[length][pos][letter] -> mask
+        self._support = dict()
+        for length, words in self._lexicon.items():
+            ids = [dict() for _ in range(length)]
+            for i, word in enumerate(words):
+                for pos, letter in enumerate(word):
+                    ids[pos].setdefault(letter, []).append(i)
+            self._support[length] = [
+                {
+                    letter: self._ids_mask(length, letter_ids)
+                    for letter, letter_ids in pos_ids.items()
+                }
+                for pos_ids in ids
+            ]
+        # Each variable's domain starts as the words of its length, so it
+        # is node-consistent from the outset
         self.domains = {
-            var: self.crossword.words.copy()
+            var: set(self._lexicon[var.length])
+            for var in self.crossword.variables
+        }
+        # Each domain mirrored as a bitmask of its word ids; kept in sync
+        # with `self.domains`
+        self._domain_mask = {
+            var: (1 << len(self._lexicon[var.length])) - 1
+            for var in self.crossword.variables
+        }
+        # Neighbors of each variable; the crossword graph never changes
+        # once built, so these can be computed once up front
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
             for var in self.crossword.variables
         }
+        # Every arc of the problem, i.e. each pair of overlapping variables
+        self._all_arcs = tuple(
+            arc for arc, overlap in self.crossword.overlaps.items()
+            if overlap is not None
+        )
+        # For each arc (x, y), one (x-words, y-words) pair of masks per
+        # letter both can have at their overlap: the allowed word pairs of
+        # the arc, tabulated by letter
+        self._arc_support = self._tabulate_arcs(self._all_arcs)
+        # Overlapping neighbors of each variable with overlap positions:
+        # self._overlap_pairs[var] -> [(neighbor, var_pos, neighbor_pos)]
+        self._overlap_pairs = {
+            var: [
+                (neighbor, *self.crossword.overlaps[var, neighbor])
+                for neighbor in self._neighbors[var]
+            ]
+            for var in self.crossword.variables
+        }
+        # Degree of each variable, used to break MRV ties
+        self._neighbor_count = {
+            var: len(self._neighbors[var])
+            for var in self.domains
+        }
 
     def letter_grid(self, assignment):
         """
-        Return 2D array representing a given assignment.
+        Return a flat list of the letters of a given assignment in
+        row-major order: the letter in row `i` and column `j` is at index
+        `i * self.crossword.width + j`, and cells without a letter hold None.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
+        width = self.crossword.width
+        letters = [None] * (self.crossword.height * width)
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            for (i, j), letter in zip(variable.cells, word):
+                letters[i * width + j] = letter
         return letters
 
     def print(self, assignment):
         """
         Print crossword assignment to the terminal.
         """
+        width = self.crossword.width
         letters = self.letter_grid(assignment)
         for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
+            for j in range(width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    print(letters[i * width + j] or " ", end="")
                 else:
                     print("█", end="")
             print()
@@ -64,8 +129,11 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
-        for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
+        # Text size only depends on the letter, so measure each one once
+        letter_sizes = dict()
+
+        for i, row in enumerate(self.crossword.structure):
+            for j, is_cell in enumerate(row):
 
                 rect = [
                     (j * cell_size + cell_border,
@@ -73,14 +141,19 @@ class CrosswordCreator():
                     ((j + 1) * cell_size - cell_border,
                      (i + 1) * cell_size - cell_border)
                 ]
-                if self.crossword.structure[i][j]:
+                if is_cell:
                     draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
+                    letter = letters[i * self.crossword.width + j]
+                    if letter:
+                        if letter not in letter_sizes:
+                            letter_sizes[letter] = draw.textsize(
+                                letter, font=font
+                            )
+                        w, h = letter_sizes[letter]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
+                            letter, fill="black", font=font
                         )
 
         img.save(filename)
@@ -93,7 +166,8 @@ class CrosswordCreator():
         if not self.ac3():
             return None
 
-        return self.backtrack(dict())
+        # ac3 has just synced the domain bitmasks, so skip backtrack's sync
+        return self._backtrack(dict())
 
     def enforce_node_consistency(self):
         """
@@ -101,71 +175,266 @@ class CrosswordCreator():
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
         """
-        remove_words = []
-        for var, domain in self.domains.items():
-            for word in domain:
-                if len(word) != var.length:
-                    remove_words.append(word)
-            for word in remove_words:
-                self.domains[var].remove(word)
-            remove_words.clear()
+        for var in self.domains:
+            self._drop_strays(var)
 
-    def revise(self, x, y):
+    def _ids_mask(self, length, ids):
+        """
+        Return the bitmask of the word ids `ids` among words of length
+        `length`. The bits are set in a byte buffer and converted to an
+        int once, rather than OR-ing ever larger ints one bit at a time.
+        """
+        bits = bytearray((len(self._lexicon[length]) + 7) // 8)
+        for i in ids:
+            bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, "little")
+
+    def _tabulate_arcs(self, arcs):
+        """
+        Return a dict mapping each arc (x, y) in `arcs` to its pairs of
+        (x-words, y-words) masks, one per letter at their overlap.
+        """
+        tables = dict()
+        for x, y in arcs:
+            ox, oy = self.crossword.overlaps[x, y]
+            y_support = self._support[y.length][oy]
+            tables[x, y] = tuple(
+                (x_words, y_support[letter])
+                for letter, x_words in self._support[x.length][ox].items()
+                if letter in y_support
+            )
+        return tables
+
+    def _extend_lexicon(self, length, words):
+        """
+        Give new ids to `words`, all of length `length` and not yet in the
+        lexicon, and update the support tables that depend on them.
+        """
+        lexicon = self._lexicon[length]
+        support = self._support[length]
+        for word in sorted(words):
+            i = len(lexicon)
+            lexicon.append(word)
+            self._word_id[word] = i
+            for pos, letter in enumerate(word):
+                support[pos][letter] = support[pos].get(letter, 0) | 1 << i
+        self._arc_support.update(self._tabulate_arcs(
+            (x, y) for x, y in self._all_arcs
+            if length in (x.length, y.length)
+        ))
+
+    def _sync_masks(self, variables):
+        """
+        Rebuild the bitmask mirrors of `variables` from `self.domains`, so
+        that domains assigned through the attribute are honoured. Words of
+        the right length missing from the lexicon are added to it; words
+        of the wrong length cannot be represented and are left out.
+        """
+        variables = set(variables)
+        new_words = dict()
+        for var in variables:
+            for word in self.domains[var]:
+                if len(word) == var.length and word not in self._word_id:
+                    new_words.setdefault(var.length, set()).add(word)
+        for length, words in new_words.items():
+            self._extend_lexicon(length, words)
+        for var in variables:
+            self._domain_mask[var] = self._ids_mask(var.length, (
+                self._word_id[word] for word in self.domains[var]
+                if len(word) == var.length
+            ))
+
+    def _drop_strays(self, var, trail=None):
+        """
+        Remove the words whose length does not match `var` from its domain,
+        recording them on `trail` if given. Such words fit no arc.
+
+        Return True if any word was removed.
+        """
+        strays = set(
+            word for word in self.domains[var] if len(word) != var.length
+        )
+        if not strays:
+            return False
+        self.domains[var].difference_update(strays)
+        if trail is not None:
+            trail.append((var, 0, strays))
+        return True
+
+    def _mask_words(self, length, mask):
+        """
+        Return the set of words of length `length` whose ids are in `mask`.
+        """
+        words = self._lexicon[length]
+        if mask.bit_count() > 64:
+            # Many words: turn the mask into a byte per id, lowest id
+            # first, and select from the word list in a single C-level pass
+            selectors = bin(mask)[:1:-1].encode("ascii")
+            return set(compress(words, selectors.translate(BINARY_DIGITS)))
+        result = set()
+        while mask:
+            bit = mask & -mask
+            result.add(words[bit.bit_length() - 1])
+            mask ^= bit
+        return result
+
+    def _prune(self, var, mask, trail=None):
+        """
+        Remove the words whose ids are in `mask` from the domain of `var`.
+        If `trail` is given, record the removal so that `_undo` can
+        restore it.
+        """
+        words = self._mask_words(var.length, mask)
+        self.domains[var].difference_update(words)
+        self._domain_mask[var] &= ~mask
+        if trail is not None:
+            trail.append((var, mask, words))
+
+    def _undo(self, trail):
+        """
+        Restore every removal recorded on `trail`, most recent first,
+        leaving `trail` empty.
+        """
+        while trail:
+            var, mask, words = trail.pop()
+            self.domains[var].update(words)
+            self._domain_mask[var] |= mask
+
+    def revise(self, x, y, trail=None):
         """
         Make variable `x` arc consistent with variable `y`.
         To do so, remove values from `self.domains[x]` for which there is no
         possible corresponding value for `y` in `self.domains[y]`.
 
+        If `trail` is given, removed values are recorded on it so that
+        they can be restored with `_undo`.
+
         Return True if a revision was made to the domain of `x`; return
         False if no revision was made.
         """
+        if (x, y) not in self._arc_support:
+            return False
+        self._sync_masks((x, y))
+        revised = self._revise(x, y, trail)
+        return self._drop_strays(x, trail) or revised
+
+    def _revise(self, x, y, trail=None):
+        """
+        Like `revise`, but trusting the bitmask mirrors of the domains.
+        """
         revised = False
-        remove_words = set()
-        if not self.crossword.overlaps[x, y]:
+        table = self._arc_support.get((x, y))
+        if table is None:
             return revised
-        overlap = self.crossword.overlaps[x, y]
-        x_words = list(self.domains[x])
-        for word_x in x_words:
-            count = 0
-            for word_y in self.domains[y]:
-                if word_x[overlap[0]] == word_y[overlap[1]]:
-                    break
-                if word_x[overlap[0]] != word_y[overlap[1]]:
-                    count += 1
-            if count == len(self.domains[y]):
-                remove_words.add(word_x)
-                revised = True
-        if remove_words:
-            for word in remove_words:
-                self.domains[x].remove(word)
+        # Union of the x-words whose letter at the overlap is still
+        # offered by some y-word
+        y_mask = self._domain_mask[y]
+        allowed = 0
+        for x_words, y_words in table:
+            if y_mask & y_words:
+                allowed |= x_words
+        removed = self._domain_mask[x] & ~allowed
+        if removed:
+            self._prune(x, removed, trail)
+            revised = True
         return revised
 
-    def ac3(self, arcs=None):
+    def ac3(self, arcs=None, trail=None):
         """
         Update `self.domains` such that each variable is arc consistent.
         If `arcs` is None, begin with initial list of all arcs in the problem.
         Otherwise, use `arcs` as the initial list of arcs to make consistent.
+        Removed values are recorded on `trail`, if given.
 
         Return True if arc consistency is enforced and no domains are empty;
         return False if one or more domains end up empty.
         """
-        queue = list()
+        arcs = self._all_arcs if arcs is None else list(arcs)
+        # Propagation can reach any variable, so every mirror is resynced;
+        # only the variables revised by `arcs` lose wrong-length words
+        self._sync_masks(self.domains)
+        emptied = False
+        for x in set(x for x, y in arcs if (x, y) in self._arc_support):
+            if self._drop_strays(x, trail) and not self.domains[x]:
+                emptied = True
+        return self._ac3(arcs, trail) and not emptied
+
+    def _ac3(self, arcs=None, trail=None):
+        """
+        Like `ac3`, but trusting the bitmask mirrors of the domains.
+        """
         if arcs is None:
-            for arc in self.crossword.overlaps:
-                if arc is not None:
-                    queue.append(arc)
-        else:
-            for arc in arcs:
-                queue.append(arc)
+            arcs = self._all_arcs
+        # Propagate on copies of the domain bitmasks, then apply the net
+        # removals to `self.domains` once at the end
+        masks = dict(self._domain_mask)
+        consistent = self._propagate(masks, arcs)
+        for var, mask in masks.items():
+            removed = self._domain_mask[var] & ~mask
+            if removed:
+                self._prune(var, removed, trail)
+        return consistent
+
+    def _propagate(self, masks, arcs):
+        """
+        Run AC-3 starting from `arcs` directly on the domain bitmasks in
+        `masks`, updating them in place. Arcs (x, y) are revised smallest
+        domain of `x` first, since small domains are the likeliest to be
+        pruned or wiped out.
+
+        Return False as soon as a domain becomes empty; return True
+        otherwise.
+        """
+        arc_support = self._arc_support
+        neighbors = self._neighbors
+        # Heap of (size of x's domain, tiebreak, arc); `queued` holds the
+        # arcs in the heap so that none is queued twice
+        tiebreak = count()
+        queue = []
+        queued = set()
+        for arc in arcs:
+            if arc not in queued:
+                queued.add(arc)
+                queue.append((masks[arc[0]].bit_count(), next(tiebreak), arc))
+        heapq.heapify(queue)
         while queue:
-            arc = queue.pop(0)
+            size, _, arc = heapq.heappop(queue)
+            # x may have shrunk since the arc was queued; requeue it with
+            # its current size if that changes its place in the order
+            current = masks[arc[0]].bit_count()
+            if current != size:
+                heapq.heappush(queue, (current, next(tiebreak), arc))
+                continue
+            queued.discard(arc)
+            table = arc_support.get(arc)
+            if table is None:
+                continue
             x, y = arc
-            if self.revise(x, y):
-                if not self.domains[x]:
+            y_mask = masks[y]
+            allowed = 0
+            for x_words, y_words in table:
+                if y_mask & y_words:
+                    allowed |= x_words
+            old_mask = masks[x]
+            x_mask = old_mask & allowed
+            if x_mask != old_mask:
+                masks[x] = x_mask
+                if not x_mask:
                     return False
-                for neighbor in self.crossword.neighbors(x):
-                    if neighbor != y:
-                        queue.append((neighbor, x))
+                for neighbor in neighbors[x]:
+                    if neighbor == y or (neighbor, x) in queued:
+                        continue
+                    # Revising (neighbor, x) can only remove something if
+                    # x no longer offers some letter at their overlap
+                    if any(
+                        old_mask & x_words and not x_mask & x_words
+                        for _, x_words in arc_support[neighbor, x]
+                    ):
+                        heapq.heappush(queue, (
+                            masks[neighbor].bit_count(), next(tiebreak),
+                            (neighbor, x)
+                        ))
+                        queued.add((neighbor, x))
         return True
 
     def assignment_complete(self, assignment):
@@ -177,20 +446,27 @@ class CrosswordCreator():
             return True
         return False
 
-    def consistent(self, assignment):
+    def consistent(self, assignment, new_var=None):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
+
+        If `new_var` is given, the rest of `assignment` is assumed to be
+        consistent already and the word of `new_var` is assumed to be
+        unused elsewhere, so only the overlaps of `new_var` are checked.
         """
+        if new_var is not None:
+            word = assignment[new_var]
+            for var_2, o1, o2 in self._overlap_pairs[new_var]:
+                if var_2 in assignment and word[o1] != assignment[var_2][o2]:
+                    return False
+            return True
         if len(assignment.values()) != len(set(assignment.values())):
             return False
         for var_1, word in assignment.items():
-            neighbors = self.crossword.neighbors(var_1)
-            for var_2 in neighbors:
-                if var_2 in assignment:
-                    overlap = self.crossword.overlaps[var_1, var_2]
-                    if assignment[var_1][overlap[0]] != assignment[var_2][overlap[1]]:
-                        return False
+            for var_2, o1, o2 in self._overlap_pairs[var_1]:
+                if var_2 in assignment and word[o1] != assignment[var_2][o2]:
+                    return False
         return True
 
     def order_domain_values(self, var, assignment):
@@ -200,22 +476,33 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        values = {}
-        words = self.domains[var]
-        neighbors = self.crossword.neighbors(var)
-        for word in words:
-            if word in assignment:
+        self._sync_masks(self._neighbors[var])
+        return self._order_domain_values(var, assignment)
+
+    def _order_domain_values(self, var, assignment):
+        """
+        Like `order_domain_values`, but trusting the bitmask mirrors of the
+        domains.
+        """
+        # For each unassigned neighbor: the position in `var`, the number
+        # of its values with each letter at the overlap, and its domain size
+        constraints = []
+        for neighbor, ox, oy in self._overlap_pairs[var]:
+            if neighbor in assignment:
                 continue
-            else:
-                count = 0
-                for neighbor in neighbors:
-                    overlap = self.crossword.overlaps[var, neighbor]
-                    if word in self.domains[neighbor]:
-                        count = count + 1
-                    for w in self.domains[neighbor]:
-                        if word[overlap[0]] != w[overlap[1]]:
-                            count = count + 1
-                values[word] = count
+            mask = self._domain_mask[neighbor]
+            letters = {
+                letter: (mask & words).bit_count()
+                for letter, words in self._support[neighbor.length][oy].items()
+            }
+            constraints.append((ox, letters, len(self.domains[neighbor])))
+        values = {}
+        for word in self.domains[var]:
+            count = 0
+            for ox, letters, size in constraints:
+                # Neighbor values whose letter differs at the overlap
+                count += size - letters.get(word[ox], 0)
+            values[word] = count
         return sorted(values, key=lambda key: values[key])
 
     def select_unassigned_variable(self, assignment):
@@ -226,54 +513,110 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        unassigned_variables = deepcopy(self.domains)
-        for var in self.domains:
-            if var in assignment:
-                unassigned_variables.pop(var)
-        lowest_count = min(unassigned_variables.items(),
-                           key=lambda x: len(x[1]))
-        for k, v in self.domains.items():
-            if k in unassigned_variables:
-                if(len(v) != len(lowest_count[1])):
-                    unassigned_variables.pop(k)
-        highest_count = max(unassigned_variables.keys(),
-                            key=lambda x: len(self.crossword.neighbors(x)))
-        return highest_count
-
-    def backtrack(self, assignment=None):
+        return min(
+            (var for var in self.domains if var not in assignment),
+            key=lambda var: (
+                len(self.domains[var]),
+                -self._neighbor_count[var]
+            )
+        )
+
+    def backtrack(self, assignment=None, used_words=None):
         """
         Using Backtracking Search, take as input a partial assignment for the
         crossword and return a complete assignment if possible to do so.
 
         `assignment` is a mapping from variables (keys) to words (values).
+        `used_words` is the set of words in `assignment`; it is computed
+        from `assignment` if not given.
 
         If no assignment is possible, return None.
         """
-        if self.assignment_complete(assignment):
-            return assignment
-        copy_domains = deepcopy(self.domains)
-        var = self.select_unassigned_variable(assignment)
-        var_words = self.order_domain_values(var, assignment)
-        for word in var_words:
+        self._sync_masks(self.domains)
+        for var in self.domains:
+            self._drop_strays(var)
+        return self._backtrack(assignment, used_words)
+
+    def _backtrack(self, assignment=None, used_words=None):
+        """
+        Like `backtrack`, but trusting the bitmask mirrors of the domains.
+        """
+        if assignment is None:
+            assignment = dict()
+        if used_words is None:
+            used_words = set(assignment.values())
+        # Search iteratively; each frame holds a variable, an iterator over
+        # its remaining ordered values and the trail of its current value
+        stack = []
+        while True:
+            if self.assignment_complete(assignment):
+                return assignment
+            var = self.select_unassigned_variable(assignment)
+            values = iter(self._order_domain_values(var, assignment))
+            stack.append((var, values, []))
+
+            # Move the deepest variable on to its next workable value,
+            # backing up past variables whose values have run out
+            while stack:
+                var, values, trail = stack[-1]
+                if var in assignment:
+                    used_words.discard(assignment.pop(var))
+                    self._undo(trail)
+                if self._assign_next(var, values, assignment, used_words,
+                                     trail):
+                    break
+                stack.pop()
+            else:
+                return None
+
+    def _assign_next(self, var, values, assignment, used_words, trail):
+        """
+        Assign to `var` the next word from the iterator `values` that is
+        not in `used_words`, is consistent with `assignment` and survives
+        forward checking, recording pruned values on `trail`.
+
+        Return True if such a word was assigned; return False if `values`
+        ran out.
+        """
+        for word in values:
+            if word in used_words:
+                continue
             assignment.update({var: word})
-            self.domains[var] = {word}
-            arcs = self.get_arcs(var, assignment)
-            self.ac3(arcs)
-            if self.consistent(assignment):
-                result = self.backtrack(assignment)
-                if result is not None:
-                    return result
-            self.domains = copy_domains
+            if self.consistent(assignment, var):
+                others = self._domain_mask[var] & ~(1 << self._word_id[word])
+                self._prune(var, others, trail)
+                if self._forward_check(var, assignment, trail):
+                    used_words.add(word)
+                    return True
+                self._undo(trail)
             assignment.pop(var)
-        return None
-
-    def get_arcs(self, var, assignment):
-        arcs = dict()
-        neighbors = self.crossword.neighbors(var)
-        for neighbor in neighbors:
-            if neighbor not in assignment:
-                arcs[neighbor, var] = 1
-        return arcs
+        return False
+
+    def _forward_check(self, var, assignment, trail=None):
+        """
+        Revise the domain of each unassigned neighbor of `var` against the
+        (single) value of `var`. Only neighbors left with a single value
+        propagate further, by running `ac3` on the arcs into them.
+        Removed values are recorded on `trail`, if given.
+
+        Return False if any domain ends up empty; return True otherwise.
+        """
+        singletons = []
+        for neighbor in self._neighbors[var]:
+            if neighbor in assignment:
+                continue
+            if self._revise(neighbor, var, trail):
+                if not self.domains[neighbor]:
+                    return False
+                if len(self.domains[neighbor]) == 1:
+                    singletons.append(neighbor)
+        arcs = [
+            (other, neighbor)
+            for neighbor in singletons
+            for other in self._neighbors[neighbor]
+            if other not in assignment
+        ]
+        return not arcs or self._ac3(arcs, trail)
 
 
 def main():